@@ -6,43 +6,100 @@ import csv
 import os
 from pyxdameraulevenshtein import damerau_levenshtein_distance_ndarray
 from post_process.utils import progress_bar, strip_tags, change_key, filter_keys
-from functools import wraps
+from functools import wraps, cached_property
+from concurrent.futures import ProcessPoolExecutor
+from post_process.cleaning.spelling import SpellingIndex, CorrectionCache, fingerprint
+from post_process.cleaning.scoring import presentation_serialpos, recalled_presentations, intrusion_lag
 
 from post_process.cleaning.plugin_processing import  html_keyboard_response_node, hold_keys_node, \
                                hold_keys_check_node, free_recall_node, \
                                free_sort_node, positional_html_display_node, \
                                math_distractor_node, countdown_node
 
-def trialdata_decorator(func):
+def trialdata_decorator(func=None, **match):
     '''
     Applies a function to the trialdata subfield of the raw structure and aggregates results,
     since most (but not all) events functions operate one data point at a time
     and the json loaded format doesn't support selection as a single operation.
 
     This decorator may interleave multiple different functions to optimize looping
-    over data.
+    over data. DataCleaner.get_events uses the match fields to build a dispatch table,
+    so that all decorated event types are extracted in a single pass over trialdata.
 
     :param func: function to apply to loop of arguments. This function should take
                  one data point as input, and return a list of the generated events.
+    :param match: trialdata fields and values a data point must have for func to be
+                  applied, eg trial_type="free-recall". Data points are dispatched on
+                  trial_type or type if either is given.
 
-    :return:     decorated function that takes a list of data points as argument,
+    :return:     decorated function that takes a SessionContext as argument,
                  runs func for each datapoint, and aggregates the result.
     '''
 
+    if func is None:
+        return lambda f: trialdata_decorator(f, **match)
+
     @wraps(func)
-    def decorated(self, raw_data):
+    def decorated(self, session):
         aggregate = []
-        trialdata = self.get_trialdata(raw_data)
-        for point in trialdata:
+        for point in session.trialdata:
 
-            if ev_data := func(self, point):
+            if _matches(point, match) and (ev_data := func(self, point)):
                 aggregate.extend(ev_data)
 
         return aggregate
 
+    decorated.record_func = func
+    decorated.match = match
+
     return decorated
 
 
+# trialdata fields used to key the single pass dispatch table, in order of preference
+DISPATCH_FIELDS = ("trial_type", "type")
+
+def _matches(point, match):
+    return all(point.get(k, None) == v for k, v in match.items())
+
+
+class SessionContext():
+    '''
+    Parsed view of a single subject's raw session, built once per subject by
+    DataCleaner.parse_session and passed to every event function, so that common
+    fields aren't re-derived from the raw structure by each of them.
+    '''
+
+    def __init__(self, raw_data, trialdata, starttime, subject, condition, counterbalance, questionnaire=None):
+        self.raw_data = raw_data
+        self.trialdata = trialdata
+        self.starttime = starttime
+        self.subject = subject
+        self.condition = condition
+        self.counterbalance = counterbalance
+        self.questionnaire = questionnaire
+
+
+# each worker process holds its own copy of the cleaner, set once by the pool initializer
+# rather than pickled alongside every subject
+_worker_state = {}
+
+def _init_worker(cleaner, verbose):
+    _worker_state["cleaner"] = cleaner
+    _worker_state["verbose"] = verbose
+
+
+def _clean_worker(subject):
+    cleaner = _worker_state["cleaner"]
+    cache = cleaner.correction_cache
+    hits, misses = cache.hits, cache.misses
+
+    raw_data = cleaner.data_container.read_session(subject)
+    result = cleaner.clean_subject(raw_data, verbose=_worker_state["verbose"])
+
+    # cache counters are per process, so each subject's share is sent back with its result
+    return result, cache.hits - hits, cache.misses - misses
+
+
 class DataCleaner():
     '''
     This class defines the operations on raw data needed to create the dataframes expected for analysis.
@@ -56,14 +113,33 @@ class DataCleaner():
     # TODO: this doesn't use the jspsych internal node id's at all, which could be used (per experiment) to
     # trivially get list, serialpos, and block information
 
+    # version of the spelling correction rules in _correct_spelling. Bump this when they change, e.g. the
+    # percentile threshold or distance function, so corrections cached under the old rules are discarded
+    SPELLING_RULES = 1
+
     def __init__(self, data_container):
         self.data_container = data_container
 
         self.modifiers = []
         self.event_types = []
 
+    def __getstate__(self):
+        # the spelling index holds memory mapped arrays, which are mapped
+        # again by each process rather than copied
+        state = self.__dict__.copy()
+        state.pop("spelling_index", None)
+        return state
+
+    @cached_property
+    def spelling_index(self):
+        return SpellingIndex(self.data_container.dictionary, counts=self.data_container.dictionary_list.counts)
+
+    @cached_property
+    def correction_cache(self):
+        return CorrectionCache(self.data_container.corrections, rules=self.SPELLING_RULES)
+
     @progress_bar()
-    def clean(self, force=False, verbose=False):
+    def clean(self, force=False, verbose=False, jobs=1, dry_run=False):
         '''
         The central function that takes raw data and yields a dataframe structured with discrete
         event types, experimental data, and derived fields. global identifiers, such as subject
@@ -71,57 +147,44 @@ class DataCleaner():
 
         :param force: overwrite existing output data
         :param verbose: show errors and list excluded subjects on exit
+        :param jobs: number of worker processes to clean subjects with. Subjects are cleaned
+                     serially in this process if jobs <= 1.
+        :param dry_run: print the subjects that would be cleaned and their cost, without
+                        processing anything
         :return: None
         '''
 
-        self.process_survey()
-        
-        raw_data_all_subs = self.data_container.get_raw_data()
-        cleaned_subs = self.data_container.get_subject_codes(cleaned=True)
+        # subjects are planned from file metadata, so sessions that are
+        # already cleaned are never parsed
+        subjects = self.plan(force=force)
+
+        if dry_run:
+            self.print_plan(subjects)
+            return
 
-        total = len(raw_data_all_subs)
+        self.process_survey()
 
         print("Cleaning subject data")
 
         errors = []
         exclude = []
 
-        for i, raw_data in enumerate(raw_data_all_subs):
-
-            # progress bar decorator expects function to generate a fraction of its total
-            yield (i/total)
-
-            events_list = []
-            subject = self.get_subject(raw_data)
-
-            if subject in cleaned_subs and not force:
-                continue
-
-            try:
-                for ev_type in self.event_types:
-                    events_list.extend(ev_type(raw_data))
-
-                events_df = pd.DataFrame(events_list)
-                events_df["subject"] = self.get_subject(raw_data)
-                events_df["condition"] = self.get_condition(raw_data)
-                events_df["counterbalance"] = self.get_counterbalance(raw_data)
-
-                del events_list
+        if jobs > 1:
+            results = self._clean_parallel(subjects, verbose, jobs)
+        else:
+            results = self._clean_serial(subjects, verbose)
 
-                for modifier in self.modifiers:
-                    events_df = modifier(events_df)
+        for progress, result in results:
 
-                # saving
-                events_df = events_df.reset_index()
-                self.data_container.save_df(events_df, subject)
+            # progress bar decorator expects function to generate a fraction of its total
+            yield progress
 
-                if(self.exclude_subject(events_df)):
-                    exclude.append(subject)
+            subject, excluded, errored = result
 
-            except Exception:
-                if verbose:
-                    tb.print_exc()
+            if errored:
                 errors.append(subject)
+            elif excluded:
+                exclude.append(subject)
 
         yield 1.0
 
@@ -130,11 +193,89 @@ class DataCleaner():
         # In principle, the database contains PHI and should
         # not be open to all analysts
         self.data_container.record_excluded(exclude + errors)
+
+        if self.data_container.use_consolidated:
+            self.data_container.consolidate()
         
         if verbose:
             print("Excluded Subjects:")
             print(exclude)
             print(errors)
+            print("Spelling correction cache:")
+            print(self.correction_cache.stats())
+
+    def plan(self, force=False):
+        '''
+        Determines the subjects that need cleaning without parsing any raw data.
+
+        :param force: plan to re-clean all subjects
+        :return: list of subject codes
+        '''
+        return self.data_container.get_stale_subjects(force=force)
+
+    def print_plan(self, subjects):
+        sizes = [self.data_container.manifest[s]["size"] for s in subjects]
+
+        print(f"{len(subjects)} subjects to clean")
+        print(f"Estimated cost: {sum(sizes) / 1e6:.1f} MB of raw data to parse", end="")
+        print(f", largest session {max(sizes) / 1e6:.1f} MB" if sizes else "")
+        print(subjects)
+
+    def _clean_serial(self, subjects, verbose):
+        total = len(subjects)
+
+        for i, raw_data in enumerate(self.data_container.iter_raw_data(subjects)):
+            yield i/total, self.clean_subject(raw_data, verbose=verbose)
+
+    def _clean_parallel(self, subjects, verbose, jobs):
+        # workers read their own session logs, so only subject codes and the small
+        # per subject results cross process boundaries. map preserves submission
+        # order, so excluded and error lists match a serial run.
+        total = len(subjects)
+
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(self, verbose)) as pool:
+            for i, (result, hits, misses) in enumerate(pool.map(_clean_worker, subjects, chunksize=max(1, total // (4 * jobs)))):
+                self.correction_cache.hits += hits
+                self.correction_cache.misses += misses
+                yield i/total, result
+
+        # cleaned files were written by the workers
+        self.data_container.refresh_manifest()
+
+    def clean_subject(self, raw_data, verbose=False):
+        '''
+        Extracts events for a single subject, applies modifiers, and saves the resulting dataframe.
+
+        :param raw_data: raw session data, as returned by the data container
+        :param verbose: show errors
+        :return: tuple of (subject, excluded, errored)
+        '''
+        subject = self.get_subject(raw_data)
+
+        try:
+            session = self.parse_session(raw_data)
+            events_list = self.get_events(session)
+
+            events_df = pd.DataFrame(events_list)
+            events_df["subject"] = session.subject
+            events_df["condition"] = session.condition
+            events_df["counterbalance"] = session.counterbalance
+
+            del events_list
+
+            for modifier in self.modifiers:
+                events_df = modifier(events_df)
+
+            # saving
+            events_df = events_df.reset_index()
+            self.data_container.save_df(events_df, subject)
+
+            return subject, self.exclude_subject(events_df), False
+
+        except Exception:
+            if verbose:
+                tb.print_exc()
+            return subject, False, True
 
     ####################
     # Collection of functions that extract pieces of common format from jspsych
@@ -155,10 +296,7 @@ class DataCleaner():
         return [record['trialdata'] for record in self.get_data(raw_data)]
 
     def get_item_id(self, item):
-        if item not in self.data_container.wordpool:
-            return -1
-
-        return self.data_container.wordpool.index(item)
+        return self.data_container.wordpool_index.get(item, -1)
 
     def get_subject(self, raw_data):
         return self.get_datastring(raw_data)['workerId']
@@ -175,45 +313,107 @@ class DataCleaner():
     def get_counterbalance(self, raw_data):
         return self.get_datastring(raw_data)["counterbalance"]
 
+    def get_eventdata(self, raw_data):
+        return self.get_datastring(raw_data)["eventdata"]
+
     def get_version(self, raw_data):
         # TODO: this needs to be grabbed from metadata, as it's not in datastring
         raise NotImplementedError("Not yet implemented")
 
-    def get_encoding_events(self, raw_data):
+    def parse_session(self, raw_data):
+        '''
+        Collects the fields used throughout event processing from raw data, so that
+        each is only derived once per subject.
+
+        :param raw_data: raw session data, as returned by the data container
+        :return: SessionContext
+        '''
+        try:
+            questionnaire = self.get_questionnaire(raw_data)
+        except (KeyError, TypeError):
+            # subjects that didn't complete the questionnaire are
+            # handled by process_survey
+            questionnaire = None
+
+        return SessionContext(raw_data,
+                              trialdata=self.get_trialdata(raw_data),
+                              starttime=self.get_starttime(raw_data),
+                              subject=self.get_subject(raw_data),
+                              condition=self.get_condition(raw_data),
+                              counterbalance=self.get_counterbalance(raw_data),
+                              questionnaire=questionnaire)
+
+    def get_encoding_events(self, session):
         raise NotImplementedError("Experiment specific")
 
-    def get_orientation_events(self, raw_data):
+    def get_orientation_events(self, session):
         raise NotImplementedError("Experiment specific")
 
-    @trialdata_decorator
+    def get_events(self, session):
+        '''
+        Runs every function in self.event_types over a parsed session. Functions wrapped with trialdata_decorator
+        are compiled into a lookup keyed by the trialdata field they match on, and all of them are applied
+        in a single pass over trialdata, so each data point only reaches the functions that want it.
+        Events are returned grouped by event type, in the same order as running each function separately.
+        '''
+        results = [[] for _ in self.event_types]
+        dispatch = {}
+        undispatched = []
+
+        for events, ev_type in zip(results, self.event_types):
+            record_func = getattr(ev_type, "record_func", None)
+
+            # functions that need the whole session are run as is
+            if record_func is None:
+                events.extend(ev_type(session))
+                continue
+
+            target = (record_func, ev_type.match, events)
+            field = next((f for f in DISPATCH_FIELDS if f in ev_type.match), None)
+
+            if field is None:
+                undispatched.append(target)
+            else:
+                dispatch.setdefault((field, ev_type.match[field]), []).append(target)
+
+        if dispatch or undispatched:
+            for point in session.trialdata:
+                targets = undispatched
+
+                for field in DISPATCH_FIELDS:
+                    if (field, point.get(field, None)) in dispatch:
+                        targets = targets + dispatch[(field, point[field])]
+
+                for record_func, match, events in targets:
+                    if _matches(point, match) and (ev_data := record_func(self, point)):
+                        events.extend(ev_data)
+
+        return [ev for events in results for ev in events]
+
+    @trialdata_decorator(trial_type="free-recall")
     def get_recall_events(self, record):
         '''
         Break nodes of type free-recall into recall events with timestamps
         '''
-        
-        if record.get("trial_type", None) == "free-recall":
-            return free_recall_node(record)
-        
+        return free_recall_node(record)
 
-    @trialdata_decorator
+    @trialdata_decorator(trial_type="math-distractor")
     def get_math_distractor_events(self, record):
         '''
         Break nodes of type math-distractor into individual events with timestamps
         dateTime -> mstime
         trialtype -> type
         '''
+        return math_distractor_node(record)
 
-        if record.get("trial_type", None) == "math-distractor":
-           return math_distractor_node(record)
-
-    def get_internal_events(self, raw_data):
+    def get_internal_events(self, session):
         '''
         eventtype -> type
         timestamp -> mstime
         value -> value
         interval -> interval
         '''
-        events = self.get_datastring(raw_data)['eventdata']
+        events = self.get_eventdata(session.raw_data)
         events = [change_key("eventtype", "type", e) for e in events]
         events = [change_key("timestamp", "mstime", e) for e in events]
 
@@ -222,15 +422,16 @@ class DataCleaner():
 
         # internal events are recorded as unixtime, task events are
         # recored by offset from task start
-        for ev in events:
-            ev["mstime"] =  ev["mstime"] - self.get_starttime(raw_data)
+        mstimes = np.asarray([ev["mstime"] for ev in events]) - session.starttime
+
+        for ev, mstime in zip(events, mstimes.tolist()):
+            ev["mstime"] = mstime
         
         return events
 
-    @trialdata_decorator
+    @trialdata_decorator(trial_type="countdown")
     def get_countdown_events(self, record):
-        if record.get("trial_type", None) == "countdown":
-           return countdown_node(record)
+        return countdown_node(record)
 
     ####################
     # Demographic survey is run at the end of every session, with processing code inherited from a previous version
@@ -261,8 +462,7 @@ class DataCleaner():
             already_processed = [row[0] for row in s]
             to_process = [code for code in to_process if code not in already_processed]
 
-        for subj in to_process:
-            data, = self.data_container.get_raw_data(subj)
+        for subj, data in zip(to_process, self.data_container.iter_raw_data(to_process)):
             cond = self.get_condition(data)
 
             try:
@@ -362,29 +562,18 @@ class DataCleaner():
 
     def add_itemno(self, events):
         events.loc[(events["type"] == 'WORD') | (events["type"] == 'REC_WORD'), "itemno"]  \
-                = events.loc[(events["type"] == 'WORD') | (events["type"] == 'REC_WORD'),"item"] \
-                        .apply(lambda x: self.get_item_id(x))
+                = self.data_container.item_ids(events.loc[(events["type"] == 'WORD') | (events["type"] == 'REC_WORD'), "item"])
 
         return events
 
     def add_serialpos(self, events):
         '''
         Adds sequential index to WORD events on the same list.
-        Requires listno and itemno fields to be populated.
+        Requires listno field to be populated. REC_WORD serial positions are
+        filled in by add_recalled_serialpos.
         '''
-
-        def find_presentation(row):
-            try:
-                return events.loc[(events["type"] == 'WORD') & (events["itemno"] == row["itemno"]) & (events["listno"] == row["listno"]), "serialpos"]
-            except KeyError:
-                return -1
-            
-
         events = events.sort_values("mstime")
-        events["temp"] = np.ones((len(events.index), ))
-        events.loc[events["type"] == 'WORD', "serialpos"] = events.loc[events["type"] == 'WORD'].groupby("listno").cumsum()["temp"]
-        events.loc[events["type"] == 'REC_WORD', "serialpos"] = events.loc[events["type"] == 'REC_WORD'].apply(find_presentation, axis=1)
-        events = events.drop("temp", axis=1)
+        events.loc[events["type"] == 'WORD', "serialpos"] = events.loc[events["type"] == 'WORD'].groupby("listno").cumcount() + 1.0
 
         return events
 
@@ -404,27 +593,18 @@ class DataCleaner():
 
     def add_intrusion(self, events):
         '''
-        uses REC_WORD and WORD events to determine if a recalled word is a PLI/XLI
+        uses REC_WORD and WORD events to determine if a recalled word is a PLI/XLI.
+        intrusion is the number of lists since the item was last presented, 0 for
+        correct recalls and -1 for XLIs. pli and pli_lag flag prior list intrusions
+        and their list lag. Requires listno and itemno fields to be populated.
         '''
         events = events.sort_values("mstime")
 
-        def check_list(row):
-            
-            presentation = events[(events["type"] == 'WORD') \
-                                  & (events["itemno"] == row["itemno"]) \
-                                  & (events["listno"] <= row["listno"])]
-
-            if len(presentation.index) == 0:
-                return -1
-            else:
-                # also captures repeated presentations
-                list_delta = row["listno"] - presentation.iloc[-1]["listno"]
-                # list_delta = list_delta.values[0] # Series are annoying
-
-                return -1 if list_delta < 0 else list_delta
-
+        lag = intrusion_lag(events)
 
-        events.loc[events["type"] == 'REC_WORD', "intrusion"] = events[events["type"] == 'REC_WORD'].apply(check_list, axis=1)
+        events.loc[events["type"] == 'REC_WORD', "intrusion"] = lag
+        events.loc[events["type"] == 'REC_WORD', "pli"] = lag > 0
+        events.loc[events["type"] == 'REC_WORD', "pli_lag"] = np.where(lag > 0, lag, np.nan)
 
         return events
 
@@ -433,35 +613,21 @@ class DataCleaner():
         uses REC_WORD and WORD events to determine if a word is recalled.
         Requires list field to be populated.
         '''
-        def find_recall(row):
-            itemno = row["itemno"]
-            recalls = events[(events["type"] == 'REC_WORD') & (events["listno"] == row["listno"])]["itemno"].values
-
-            return itemno in recalls
-
         events = events.sort_values("mstime")
 
-        events.loc[events["type"] =="WORD", "recalled"] = events.loc[events["type"] == "WORD"].apply(find_recall, axis=1)
+        events.loc[events["type"] == "WORD", "recalled"] = recalled_presentations(events)
 
         return events
 
     def add_recalled_serialpos(self, events):
         '''
-        uses REC_WORD and WORD events to determine if a recalled word is a PLI/XLI
+        uses REC_WORD and WORD events to find the serial position of each recalled word
+        on its list, or -1 for PLI/XLIs. Requires listno, itemno, and serialpos fields
+        to be populated.
         '''
         events = events.sort_values("mstime")
 
-        def check_list(row):
-            
-            presentation = events[(events["type"] == 'WORD') & (events["itemno"] == row["itemno"]) & (events["listno"] == row["listno"])]
-
-            if len(presentation.index) == 0:
-                return -1
-            else:
-                # captures first presentation for repeats
-                return presentation["serialpos"].values[0] # series are annoying
-
-        events.loc[events["type"] == 'REC_WORD', "serialpos"] = events[events["type"] == 'REC_WORD'].apply(check_list, axis=1)
+        events.loc[events["type"] == 'REC_WORD', "serialpos"] = presentation_serialpos(events)
 
         return events
 
@@ -508,19 +674,26 @@ class DataCleaner():
         '''
         spellcheck recalls and update item and itemno fields
         '''
-        def apply_correction(row):
-            item = row["item"]
+        recalls = events["type"] == "REC_WORD"
+        words = events[events["type"] == 'WORD']
+        word_items, word_lists = words["item"].values, words["listno"].values
 
-            presented = events[(events["listno"] <= row["listno"]) & (events["type"] == 'WORD')]["item"].values
+        # each recalled word is only corrected once per list, against the words presented
+        # up to that list, and exact matches are passed through
+        corrected = []
+        for listno, items in events.loc[recalls, "item"].groupby(events.loc[recalls, "listno"], sort=False, dropna=False):
+            presented = word_items[word_lists <= listno]
+            known = set(presented)
 
-            ret = self._correct_spelling(item, presented)
-            return ret
+            corrections = {item: item if item in known else self._correct_spelling(item, presented) for item in items.unique()}
+            corrected.append(items.map(corrections))
 
         # apply correction to every word event
-        events.loc[events["type"] == "REC_WORD", "item"] = events[events["type"] == "REC_WORD"].apply(apply_correction, axis=1)
+        if corrected:
+            events.loc[recalls, "item"] = pd.concat(corrected)
 
         # search for word num on all events
-        events.loc[events["type"] == "REC_WORD", "itemno"] = events[events["type"] == "REC_WORD"].apply(lambda x: self.get_item_id(x["item"]), axis=1)
+        events.loc[events["type"] == "REC_WORD", "itemno"] = self.data_container.item_ids(events.loc[events["type"] == "REC_WORD", "item"])
 
         # add recalled to all word events
         events = self.add_recalled(events)
@@ -554,15 +727,25 @@ class DataCleaner():
         if recall in presented:
             return recall
 
-        # edit distance to each item in the pool and dictionary
+        key = (recall, fingerprint(presented), self.data_container.dictionary_hash, self.data_container.wordpool_hash)
+
+        if (correction := self.correction_cache.get(key)) is not None:
+            return correction
+
+        # edit distance to each item in the pool, and to dictionary words at least as close
         dist_to_pool = damerau_levenshtein_distance_ndarray(recall, np.asarray(presented))
-        dist_to_dict = damerau_levenshtein_distance_ndarray(recall, np.asarray(self.data_container.dictionary))
+        dict_matches, dist_to_dict = self.spelling_index.within(recall, np.amin(dist_to_pool))
     
-        # position in distribution of dist_to_dict
-        ptile = np.true_divide(sum(dist_to_dict <= np.amin(dist_to_pool)), dist_to_dict.size)
+        # position in distribution of distances to the dictionary
+        ptile = np.true_divide(dict_matches.size, len(self.spelling_index))
     
-        # decide if it is a word in the pool or an ELI
+        # decide if it is a word in the pool or an ELI. As ptile > 0, the
+        # closest dictionary word is among the matches.
         if ptile <= .1:
-            return presented[np.argmin(dist_to_pool)]
+            correction, source = presented[np.argmin(dist_to_pool)], "pool"
         else:
-            return self.data_container.dictionary[np.argmin(dist_to_dict)]
+            correction, source = self.data_container.dictionary[dict_matches[np.argmin(dist_to_dict)]], "dictionary"
+
+        self.correction_cache.put(key, correction, source, np.amin(dist_to_pool), ptile)
+
+        return correction
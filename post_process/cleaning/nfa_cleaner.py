@@ -4,5 +4,6 @@ class NFACleaner(DataCleaner):
     def __init__(self, data_container):
         super().__init__(data_container)
 
-    def clean(self, force=False, verbose=False):
-        self.process_survey()
+    def clean(self, force=False, verbose=False, jobs=1, dry_run=False):
+        if not dry_run:
+            self.process_survey()
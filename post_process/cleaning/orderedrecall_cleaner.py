@@ -16,29 +16,24 @@ class OrderedRecallCleaner(DataCleaner):
                           self.add_serialpos,
                           self.add_recalled]
 
-    @trialdata_decorator
+    @trialdata_decorator(type="recall")
     def get_recall_events(self, record):
         # entirely different from normal recall, deals with both final recall and repositioning
+        return free_sort_node(record)
 
-        if record.get("type", None) == "recall":
-            return free_sort_node(record)
-
-    @trialdata_decorator
+    @trialdata_decorator(type="encoding")
     def get_encoding_events(self, record):
         # much like regular encoding, just also needs vertical position on screen 
-        if record.get("type", None) == "encoding":
-            return positional_html_display_node(record)
+        return positional_html_display_node(record)
 
-    @trialdata_decorator
+    @trialdata_decorator(type="check")
     def get_hold_keys_events(self, record):
-            if record.get("type", None) == "check":
-                return hold_keys_check_node(record)
+        return hold_keys_check_node(record)
 
     def add_itemno(self, events):
 
         events.loc[events["type"] == 'WORD', "itemno"]  \
-                = events.loc[events["type"] == 'WORD', "item"] \
-                        .apply(lambda x: self.get_item_id(x))
+                = self.data_container.item_ids(events.loc[events["type"] == 'WORD', "item"])
 
         events.loc[events["type"] == 'END_RECALL', "itemnos"]  \
                 = events.loc[events["type"] == 'END_RECALL', "end_positions"] \
@@ -19,14 +19,11 @@ class PresRateCleaner(DataCleaner):
                           self.add_intrusion]
 
 
-    def get_encoding_events(self, raw_data):
-        data = raw_data["data"]
+    def get_encoding_events(self, session):
         events = []
         wanted_keys = ["block", "length", "pr"]
 
-        for record in data:
-            trialdata = record["trialdata"]
-            
+        for trialdata in session.trialdata:
             if trialdata.get("type", None) == "encoding" \
                 or trialdata.get("type", None) == "practice":
                 event = {}
@@ -43,16 +40,13 @@ class PresRateCleaner(DataCleaner):
         return events
 
 
-    def get_recall_events_hack(self, raw_data):
+    def get_recall_events_hack(self, session):
         '''
         Break nodes of type free-recall into recall events with timestamps
         '''
 
-        data = raw_data["data"]
         events = []
-        for record in data:
-            trialdata = record["trialdata"]
-
+        for trialdata in session.trialdata:
             if trialdata.get("trial_type", None) == "free-recall":
                 recwords = trialdata["recwords"] 
                 rts = trialdata["rt"]
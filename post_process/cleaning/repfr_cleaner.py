@@ -24,20 +24,17 @@ class RepFRCleaner(DataCleaner):
                 self.add_recalled_serialpos,
                 self.add_intrusion]
 
-    @trialdata_decorator
+    @trialdata_decorator(type="encoding")
     def get_encoding_events(self, record):
-        if record.get("type", None) == "encoding":
-            node_events = hold_keys_node(record)
-            return node_events
+        node_events = hold_keys_node(record)
+        return node_events
 
 
-    @trialdata_decorator
+    @trialdata_decorator(trial_type="hold-keys", type="fixation")
     def get_rest_events(self, record):
-        if record.get("trial_type", None) == "hold-keys" \
-                and record.get("type", None) == 'fixation':
-                node_data, = hold_keys_node(record)
-                node_data["type"] = "REST"
-                return (node_data, )
+        node_data, = hold_keys_node(record)
+        node_data["type"] = "REST"
+        return (node_data, )
 
     def add_repeats(self, events):
 
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+# Vectorized scoring of recalls against presentations. Recall (REC_WORD) and
+# presentation (WORD) events are matched by joining on (listno, itemno) once per
+# subject, rather than masking the whole events frame for every row.
+#
+# Missing itemnos never match, in keeping with the element-wise comparisons
+# these functions replace.
+
+
+def _keys(events, event_type):
+    return events.loc[events["type"] == event_type, ["listno", "itemno"]]
+
+
+def presentation_serialpos(events):
+    '''
+    Finds the serial position at which each recalled item was presented on its list.
+    For repeated presentations, the first presentation is used.
+
+    :param events: events dataframe with type, listno, itemno, and serialpos populated
+                   for WORD events, sorted by mstime
+    :return: array with a serial position for each REC_WORD event, in order, or -1 if
+             the recalled item wasn't presented on the same list
+    '''
+    words = events.loc[events["type"] == 'WORD', ["listno", "itemno", "serialpos"]]
+    words = words.dropna(subset=["itemno"]) \
+                 .drop_duplicates(subset=["listno", "itemno"], keep="first") \
+                 .set_index(["listno", "itemno"])["serialpos"]
+
+    match = words.index.get_indexer(pd.MultiIndex.from_frame(_keys(events, 'REC_WORD')))
+
+    # unmatched recalls index the appended -1
+    return np.append(words.values, -1)[match]
+
+
+def recalled_presentations(events):
+    '''
+    Finds whether each presented item was recalled on the same list.
+
+    :param events: events dataframe with type, listno, and itemno populated
+    :return: boolean array for each WORD event, in order
+    '''
+    recalls = _keys(events, 'REC_WORD').dropna(subset=["itemno"])
+
+    return pd.MultiIndex.from_frame(_keys(events, 'WORD')) \
+             .isin(pd.MultiIndex.from_frame(recalls))
+
+
+def intrusion_lag(events):
+    '''
+    Finds how many lists back each recalled item was most recently presented, so
+    correct recalls are 0, prior list intrusions (PLIs) are the list lag to their
+    presentation, and extra list intrusions (XLIs) are -1.
+
+    :param events: events dataframe with type, listno, and itemno populated
+    :return: array with a lag for each REC_WORD event, in order
+    '''
+    words = _keys(events, 'WORD').dropna(subset=["itemno"]).drop_duplicates()
+    words["presented_listno"] = words["listno"]
+
+    recalls = _keys(events, 'REC_WORD')
+    recalls["order"] = np.arange(len(recalls.index))
+    recalls = recalls.dropna(subset=["itemno"])
+
+    # merge_asof can't group on float keys, and itemnos are integer ids
+    words["itemno"] = words["itemno"].astype(np.int64)
+    recalls["itemno"] = recalls["itemno"].astype(np.int64)
+
+    # most recent presentation on or before each recall's list, which needs both
+    # sides sorted on listno
+    matched = pd.merge_asof(recalls.sort_values("listno", kind="mergesort"),
+                            words.sort_values("listno", kind="mergesort"),
+                            on="listno", by="itemno", direction="backward")
+
+    lag = np.full(len(events.index[events["type"] == 'REC_WORD']), -1.0)
+    lag[matched["order"].values] = (matched["listno"] - matched["presented_listno"]).fillna(-1).values
+
+    return lag
@@ -22,8 +22,7 @@ class SerialRecCleaner(DataCleaner):
                           self.add_intrusion]
 
 
-    @trialdata_decorator
+    @trialdata_decorator(type="encoding")
     def get_encoding_events(self, record):
-        if record.get("type", None) == "encoding":
-            node_events = hold_keys_node(record)
-            return node_events
+        node_events = hold_keys_node(record)
+        return node_events
@@ -0,0 +1,220 @@
+import hashlib
+import sqlite3
+import time
+import numpy as np
+from pyxdameraulevenshtein import damerau_levenshtein_distance_ndarray
+
+# letters get their own bucket in character counts, everything else shares the last
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+N_BUCKETS = len(ALPHABET) + 1
+
+
+def _buckets(codepoints):
+    buckets = codepoints.astype(np.int64) - ord("A")
+    buckets[(buckets < 0) | (buckets >= len(ALPHABET))] = len(ALPHABET)
+
+    return buckets
+
+
+def char_counts(words):
+    '''
+    Counts characters of each word into N_BUCKETS buckets.
+
+    :param words: list of strings
+    :return: (N_BUCKETS, len(words)) array of counts, so each bucket is contiguous
+    '''
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    codepoints = np.frombuffer("".join(words).encode("utf-32-le"), dtype=np.uint32)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+
+    counts = np.bincount(_buckets(codepoints) * len(lengths) + rows, minlength=N_BUCKETS * len(lengths))
+
+    return counts.reshape(N_BUCKETS, len(lengths)).astype(np.int16)
+
+
+class SpellingIndex():
+    '''
+    Answers edit distance queries against a dictionary without computing the distance
+    to every word. Each insertion, deletion, or substitution changes the character counts
+    of a word by at most one on either side, and transpositions don't change them, so
+    the bag distance between character counts is a lower bound on the Damerau-Levenshtein
+    distance. Exact distances are only computed for words whose bound is close enough,
+    and results are identical to a full scan, including ties going to the first word in
+    dictionary order.
+    '''
+
+    def __init__(self, dictionary, counts=None):
+        self.words = np.asarray(dictionary)
+        self.counts = char_counts(list(dictionary)) if counts is None else counts
+        self.lengths = self.counts.sum(axis=0, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.words)
+
+    def lower_bounds(self, word):
+        # the bag distance is the longer length less the characters in common,
+        # which only involves the buckets word has characters in
+        query = char_counts([word])[:, 0]
+        common = np.zeros(len(self.words), dtype=np.int16)
+
+        for bucket in np.flatnonzero(query):
+            common += np.minimum(self.counts[bucket], query[bucket])
+
+        return np.maximum(self.lengths, len(word)) - common
+
+    def within(self, word, distance):
+        '''
+        Finds all dictionary words within an edit distance of word.
+
+        :return: tuple of dictionary indices, in dictionary order, and their distances
+        '''
+        candidates = np.flatnonzero(self.lower_bounds(word) <= distance)
+        distances = damerau_levenshtein_distance_ndarray(word, self.words[candidates])
+        close = distances <= distance
+
+        return candidates[close], distances[close]
+
+    def nearest(self, word):
+        '''
+        Finds the dictionary word with the smallest edit distance to word.
+
+        :return: tuple of dictionary index and distance
+        '''
+        bounds = self.lower_bounds(word)
+        best_index, best_distance = -1, np.inf
+
+        # words can't be closer than their bound, so stop once bounds exceed the best distance
+        for bound in np.unique(bounds):
+            if bound > best_distance:
+                break
+
+            candidates = np.flatnonzero(bounds == bound)
+            distances = damerau_levenshtein_distance_ndarray(word, self.words[candidates])
+            i = np.argmin(distances)
+
+            if distances[i] < best_distance or (distances[i] == best_distance and candidates[i] < best_index):
+                best_index, best_distance = candidates[i], distances[i]
+
+        return best_index, best_distance
+
+
+def fingerprint(words):
+    '''
+    Hash of a sequence of words. Order of first occurrence is kept, as it decides
+    ties between equally close words.
+    '''
+    return hashlib.sha1("\n".join(dict.fromkeys(str(w) for w in words)).encode()).hexdigest()
+
+
+class CorrectionCache():
+    '''
+    Persistent cache of spelling corrections, kept in SQLite so that corrections are
+    reused across subjects and runs. Entries are keyed by the recall, a fingerprint
+    of the presented words, and hashes of the dictionary and wordpool, and record the
+    distance and percentile behind each decision so that they can be audited. Oldest
+    entries are evicted once there are more than max_entries.
+
+    :param rules: version of the rules corrections are made with. The cache is cleared
+                  when it was filled under other rules.
+    '''
+
+    def __init__(self, path, rules=1, max_entries=200000):
+        self.path = path
+        self.rules = rules
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._entries = None
+
+    def __getstate__(self):
+        # connections can't be shared across processes, each worker opens its own
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+            # WAL doesn't work on network filesystems, and is kept by databases once set, so caches
+            # are switched back to the default rollback journal. Other processes with the cache
+            # open can stop that, in which case it's switched by a later run.
+            try:
+                self._conn.execute("PRAGMA journal_mode=DELETE")
+            except sqlite3.OperationalError:
+                pass
+
+            # rules are kept as the database's user_version, and checked under a write lock
+            # so that only the first process to open the cache after the rules change clears it
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.rules:
+                self._conn.execute("DROP TABLE IF EXISTS corrections")
+                self._conn.execute(f"PRAGMA user_version = {int(self.rules)}")
+
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS corrections (
+                                      recall TEXT NOT NULL,
+                                      presented TEXT NOT NULL,
+                                      dictionary TEXT NOT NULL,
+                                      wordpool TEXT NOT NULL,
+                                      correction TEXT NOT NULL,
+                                      source TEXT NOT NULL,
+                                      distance INTEGER NOT NULL,
+                                      percentile REAL NOT NULL,
+                                      created REAL NOT NULL,
+                                      PRIMARY KEY (recall, presented, dictionary, wordpool))""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS corrections_created ON corrections (created)")
+            self._conn.execute("COMMIT")
+
+        return self._conn
+
+    def get(self, key):
+        '''
+        Lookups only read, so that processes sharing the cache don't queue behind each other.
+
+        :param key: tuple of (recall, presented fingerprint, dictionary hash, wordpool hash)
+        :return: cached correction, or None
+        '''
+        row = self.conn.execute("SELECT correction FROM corrections WHERE recall=? AND presented=? AND dictionary=? AND wordpool=?",
+                                key).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return row[0]
+
+    def put(self, key, correction, source, distance, percentile):
+        '''
+        :param key: tuple of (recall, presented fingerprint, dictionary hash, wordpool hash)
+        :param correction: corrected word
+        :param source: whether the correction came from the presented words ("pool") or the "dictionary"
+        :param distance: edit distance to the closest presented word
+        :param percentile: proportion of the dictionary at least as close as the closest presented word
+        '''
+        self.conn.execute("INSERT OR REPLACE INTO corrections (recall, presented, dictionary, wordpool, correction, source, distance, percentile, created) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (*key, correction, source, int(distance), float(percentile), time.time()))
+
+        if self._entries is None:
+            self._entries = self.conn.execute("SELECT COUNT(*) FROM corrections").fetchone()[0]
+        else:
+            self._entries += 1
+
+        if self._entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        # trim to 90% of capacity, so eviction isn't run on every insert
+        self.conn.execute("DELETE FROM corrections WHERE rowid IN "
+                          "(SELECT rowid FROM corrections ORDER BY created LIMIT "
+                          "max(0, (SELECT COUNT(*) FROM corrections) - ?))", (int(self.max_entries * .9), ))
+        self._entries = self.conn.execute("SELECT COUNT(*) FROM corrections").fetchone()[0]
+
+    def stats(self):
+        entries = self.conn.execute("SELECT COUNT(*) FROM corrections").fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
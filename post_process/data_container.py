@@ -1,21 +1,116 @@
 import pandas as pd
 import json
 import os
+import hashlib
+import fcntl
+import operator
 from functools import cached_property, reduce
-from glob import glob
 import importlib.resources as pkg_resources
 import post_process.resources as resources
+from post_process.schema import get_event_schema, apply_schema, memory_report
+from post_process.wordlists import get_wordlist
+from post_process.decoding import load, open_raw, decode_session, read_cached_session, write_cached_session
+
+
+# file extension of each supported format for cleaned data
+CLEANED_FORMATS = {"json": ".json", "parquet": ".parquet", "feather": ".feather"}
+
+# file extension of raw data for each supported compression
+RAW_COMPRESSIONS = {None: ".json", "gzip": ".json.gz", "zstd": ".json.zst"}
+
+# row filters for reading cleaned data, as (column, op, value) tuples in the style of
+# pyarrow filters. Missing values never match, including for != and not in.
+FILTER_OPS = {"==": operator.eq,
+              "!=": lambda col, value: col.ne(value) & col.notna(),
+              "<": operator.lt,
+              "<=": operator.le,
+              ">": operator.gt,
+              ">=": operator.ge,
+              "in": lambda col, value: col.isin(value),
+              "not in": lambda col, value: ~col.isin(value) & col.notna()}
+
+
+def filter_rows(df, where):
+    mask = pd.Series(True, index=df.index)
+
+    for col, op, value in where:
+        mask &= FILTER_OPS[op](df[col], value)
+
+    return df[mask.values]
+
+
+def _read_columns(columns, where):
+    # filter columns need to be read even if they aren't kept
+    if columns is not None and where:
+        return list(dict.fromkeys(list(columns) + [col for col, _, _ in where]))
+    else:
+        return columns
+
+
+def _unify_schemas(schemas):
+    '''
+    Merges arrow schemas by column name, in order of first appearance. Conflicting types
+    are promoted where arrow allows it, e.g. integers and doubles become doubles, and
+    become strings otherwise. All null columns take the type they have elsewhere.
+    '''
+    import pyarrow as pa
+
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, set())
+
+            if not pa.types.is_null(field.type):
+                types[field.name].add(field.type)
+
+    fields = []
+    for name, col_types in types.items():
+        try:
+            fields.append(pa.unify_schemas([pa.schema([pa.field(name, t)]) for t in col_types] or [pa.schema([pa.field(name, pa.null())])],
+                                           promote_options="permissive").field(name))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            fields.append(pa.field(name, pa.string()))
+
+    return pa.schema(fields)
+
+
+def _conform(table, schema):
+    import pyarrow as pa
+
+    def conform_column(field):
+        if field.name not in table.column_names:
+            return pa.nulls(table.num_rows, field.type)
+
+        column = table.column(field.name)
+
+        try:
+            return column.cast(field.type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            # e.g. lists in a column that's strings elsewhere
+            return pa.array([None if v is None else str(v) for v in column.to_pylist()], type=field.type)
+
+    return pa.Table.from_arrays([conform_column(field) for field in schema], schema=schema)
 
 
 class DataContainer():
     ''' Class that wraps file io and management of experiment files. This doesn't retain
-    any information about the internal format of said files aside from their being
-    json files. Users of this class will receive data as a dictionary if reading
+    any information about the internal format of said files aside from raw data being
+    json files, optionally compressed as set by raw_compression, and cleaned data being
+    json, parquet, or feather files, as set by cleaned_format. Raw files are read in any
+    compression regardless of raw_compression, which only sets how new files are written.
+    Cleaned data is read in the format it was last written in unless cleaned_format is
+    given, in which case subjects are converted as they're cleaned again. Users of this class will receive data as a dictionary if reading
     raw data or as a dataframe for cleaned data, and must validate the internal format
     themselves.
     '''
 
-    def __init__(self, root='/', experiment='', survey="survey_responses.csv", db='', dictionary=None, wordpool=None, class_exp=False):
+    def __init__(self, root='/', experiment='', survey="survey_responses.csv", db='', dictionary=None, wordpool=None, class_exp=False, cleaned_format=None, consolidated=False, session_cache=True, raw_compression=None):
+        if cleaned_format is not None and cleaned_format not in CLEANED_FORMATS:
+            raise ValueError(f"cleaned_format must be one of {list(CLEANED_FORMATS)}, not {cleaned_format}")
+
+        if raw_compression not in RAW_COMPRESSIONS:
+            raise ValueError(f"raw_compression must be one of {list(RAW_COMPRESSIONS)}, not {raw_compression}")
+
         self.root = root
         self.experiment = experiment
         self.db = db
@@ -23,6 +118,12 @@ class DataContainer():
         self._survey = survey
         self._dictionary = dictionary
         self._wordpool = wordpool
+        self._cleaned_format = cleaned_format
+        self.use_consolidated = consolidated
+        self.use_session_cache = session_cache
+        self.raw_compression = raw_compression
+        self._manifest = None
+        self._collections = {}
 
     @property
     def raw(self):
@@ -32,6 +133,22 @@ class DataContainer():
     def cleaned(self):
         return os.path.join(self.root, self.experiment, "cleaned")
 
+    @property
+    def consolidated(self):
+        return os.path.join(self.root, self.experiment, "cleaned.parquet")
+
+    @property
+    def sessions(self):
+        return os.path.join(self.root, self.experiment, "sessions")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, self.experiment, "manifest.json")
+
+    @property
+    def watermark_path(self):
+        return os.path.join(self.root, self.experiment, "watermark.json")
+
     @property
     def reports(self):
         return os.path.join(self.root, self.experiment, "reports")
@@ -40,42 +157,278 @@ class DataContainer():
     def survey(self):
         return os.path.join(self.root, self.experiment, self._survey)
 
+    @property
+    def corrections(self):
+        return os.path.join(self.root, self.experiment, "corrections.db")
+
     @cached_property
-    def dictionary(self):
+    def cleaned_format(self):
+        '''
+        Format cleaned data is read and written in. Unless set explicitly, this is the format
+        of the most recently written cleaned file, or json for experiments that haven't been
+        cleaned.
+        '''
+        if self._cleaned_format is not None:
+            return self._cleaned_format
+
+        newest = {}
+        for entry in self._scan(self.cleaned, tuple(CLEANED_FORMATS.values())):
+            cleaned_format = next(f for f, ext in CLEANED_FORMATS.items() if entry.name.endswith(ext))
+            newest[cleaned_format] = max(newest.get(cleaned_format, 0), entry.stat().st_mtime)
+
+        return max(newest, key=newest.get) if newest else "json"
+
+    # word lists are memory mapped from compiled arrays, see post_process.wordlists
+
+    @cached_property
+    def dictionary_list(self):
         if self._dictionary:
-            with open(os.path.join(self.root, self._dictionary), "r") as f:
-                return [w.strip().upper() for w in f.readlines()]
+            return get_wordlist(os.path.join(self.root, self._dictionary))
         else:
-            return [w.strip().upper() for w in pkg_resources.read_text(resources, 'webster_dictionary.txt').split()]
+            with pkg_resources.path(resources, 'webster_dictionary.txt') as path:
+                return get_wordlist(str(path), lines=False)
 
     @cached_property
-    def wordpool(self):
+    def wordpool_list(self):
         if self._wordpool:
-            with open(os.path.join(self.root, self.experiment, self._wordpool), "r") as f:
-                return [w.strip().upper() for w in f.readlines()]
+            return get_wordlist(os.path.join(self.root, self.experiment, self._wordpool))
         else:
-            return [w.strip().upper() for w in pkg_resources.read_text(resources, 'wordpool.txt').split()]
+            with pkg_resources.path(resources, 'wordpool.txt') as path:
+                return get_wordlist(str(path), lines=False)
+
+    @property
+    def dictionary(self):
+        return self.dictionary_list.words
+
+    @property
+    def wordpool(self):
+        return self.wordpool_list.words
+
+    @property
+    def dictionary_hash(self):
+        return self.dictionary_list.hash
+
+    @property
+    def wordpool_hash(self):
+        return self.wordpool_list.hash
+
+    def __getstate__(self):
+        # memory mapped arrays would be copied into the pickle, so processes
+        # map word lists again instead
+        state = self.__dict__.copy()
+        state.pop("dictionary_list", None)
+        state.pop("wordpool_list", None)
+        return state
+
+    @cached_property
+    def wordpool_index(self):
+        # first occurrence wins for duplicated words, as with list.index
+        index = {}
+        for i, word in enumerate(self.wordpool):
+            index.setdefault(word, i)
+
+        return index
+
+    def item_ids(self, items):
+        '''
+        Vectorized lookup of wordpool ids.
+
+        :param items: pandas series of items
+        :return: series of ids aligned with items, -1 for items not in the wordpool
+        '''
+        return items.map(self.wordpool_index).fillna(-1).astype(int)
+
+    def write_session_log(self, raw, code):
+        '''
+        Writes a raw session log, compressed as set by raw_compression. Any existing raw file
+        for the subject in another compression is replaced.
+        '''
+        path = self.path_from_code(code)
+        existing = self.manifest.get(code, {}).get("raw")
+
+        with open_raw(path, 'wb') as f:
+            f.write(json.dumps(raw).encode())
+
+        if existing is not None and existing != path:
+            os.remove(existing)
 
     @staticmethod
     def read_session_log(file):
-        with open(file, 'r') as f:
-            raw = json.load(f)
+        # server responses may be sent as
+        # json parsed as a string
+        return decode_session(load(file))
 
-        for key in raw.keys():
-            # server responses may be sent as
-            # json parsed as a string
+    def read_session(self, code):
+        '''
+        Reads a subject's raw session log. With the session cache enabled and msgpack installed,
+        decoded sessions are kept in the sessions directory, so raw json is only parsed again
+        once the raw file's content changes. The cache is used as is while the raw file's size
+        and modification time match the ones it was saved with, and the raw file is only hashed
+        when they don't, to tell files that were rewritten from ones that changed.
+        '''
+        path = self.manifest[code]["raw"]
 
-            try:
-                raw[key] = json.loads(raw[key])
-            except ValueError:
-                continue
-            except TypeError:
-                continue
+        if not self.use_session_cache:
+            return self.read_session_log(path)
+
+        cache_path = os.path.join(self.sessions, f"{code}.msgpack")
+        stat = os.stat(path)
+
+        header, raw = read_cached_session(cache_path)
+
+        if header is not None and (header.get("size"), header.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns):
+            return raw
+
+        content_hash = self.content_hash(code)
+
+        if header is None or header.get("hash") != content_hash:
+            raw = self.read_session_log(path)
+
+        # the cache is skipped where the experiment directory isn't writable, e.g. for shared data
+        try:
+            os.makedirs(self.sessions, exist_ok=True)
+            write_cached_session(cache_path, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash}, raw)
+        except OSError:
+            pass
 
         return raw
 
-    def filter_files_by_subject(self, files, subjects):
-        files = [f for f in files if self.code_from_path(f) in subjects]
+    @property
+    def manifest(self):
+        '''
+        Dict of subject code to an entry with the subject's raw and cleaned paths, raw size,
+        modification times, raw content hash, and status, which is one of "raw" (not yet
+        cleaned), "stale" (raw data changed since cleaning), "cleaned", or "excluded". Built
+        from one listing of the raw and cleaned directories, and kept up to date as the
+        container writes files.
+        '''
+        if self._manifest is None:
+            self.refresh_manifest()
+
+        return self._manifest
+
+    def refresh_manifest(self):
+        '''
+        Rebuilds the manifest from the raw and cleaned directories, for when files are
+        written outside of the container. Content hashes from the saved manifest are kept
+        for raw files whose size and modification time haven't changed.
+        '''
+        saved = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                saved = json.load(f)
+
+        saved.update(self._manifest or {})
+
+        manifest = {}
+        for entry in self._scan(self.raw, tuple(RAW_COMPRESSIONS.values())):
+            code = self.code_from_path(entry.path)
+            stat = entry.stat()
+            old = saved.get(code, {})
+
+            manifest[code] = {"code": code,
+                              "raw": entry.path,
+                              "cleaned": None,
+                              "size": stat.st_size,
+                              "mtime": stat.st_mtime,
+                              "hash": old.get("hash") if (old.get("size"), old.get("mtime")) == (stat.st_size, stat.st_mtime) else None,
+                              "cleaned_mtime": None}
+
+        for entry in self._scan(self.cleaned, CLEANED_FORMATS[self.cleaned_format]):
+            code = self.code_from_path(entry.path)
+            manifest.setdefault(code, {"code": code, "raw": None, "size": None, "mtime": None, "hash": None})
+            manifest[code].update(cleaned=entry.path, cleaned_mtime=entry.stat().st_mtime)
+
+        self._manifest = dict(sorted(manifest.items()))
+
+        bad_subs = self.get_bad_subs()
+        for entry in self._manifest.values():
+            self._update_status(entry, bad_subs)
+
+        self.write_manifest()
+
+    def write_manifest(self):
+        '''
+        Saves the manifest if the experiment directory is writable. Otherwise, e.g. when
+        reading shared data, the manifest is only kept in memory.
+        '''
+        if not os.path.isdir(os.path.dirname(self.manifest_path)):
+            return
+
+        tmp = f"{self.manifest_path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._manifest, f)
+
+            os.replace(tmp, self.manifest_path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def read_watermark(self):
+        '''
+        Watermark of the last extraction from the database, with the latest end date of
+        subjects extracted ("endhit", as an iso date) and the uniqueids of subjects on or
+        after it, or without an end date, that have already been extracted ("uniqueids").
+
+        :return: watermark dict, or None if data hasn't been extracted before
+        '''
+        if not os.path.exists(self.watermark_path):
+            return None
+
+        with open(self.watermark_path, 'r') as f:
+            return json.load(f)
+
+    def write_watermark(self, watermark):
+        os.makedirs(os.path.dirname(self.watermark_path), exist_ok=True)
+
+        tmp = f"{self.watermark_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(watermark, f)
+
+        os.replace(tmp, self.watermark_path)
+
+    @staticmethod
+    def _scan(directory, extension):
+        if not os.path.isdir(directory):
+            return []
+
+        with os.scandir(directory) as entries:
+            return [e for e in entries if e.name.endswith(extension) and e.is_file()]
+
+    @staticmethod
+    def _update_status(entry, bad_subs):
+        if entry["cleaned"] is None:
+            entry["status"] = "raw"
+        elif entry["mtime"] is not None and entry["mtime"] > entry["cleaned_mtime"]:
+            entry["status"] = "stale"
+        elif entry["code"] in bad_subs:
+            entry["status"] = "excluded"
+        else:
+            entry["status"] = "cleaned"
+
+    def content_hash(self, code):
+        '''
+        :return: sha1 of the subject's raw file, computed once per version of the file
+        '''
+        entry = self.manifest[code]
+
+        if entry["hash"] is None:
+            sha1 = hashlib.sha1()
+            with open(entry["raw"], 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+
+            entry["hash"] = sha1.hexdigest()
+
+        return entry["hash"]
+
+    def get_subject_files(self, subjects, cleaned=False):
+        '''
+        :return: raw or cleaned paths for subjects, in the same order as subjects
+        '''
+        key = "cleaned" if cleaned else "raw"
+        files = [self.manifest[s][key] for s in subjects if s in self.manifest and self.manifest[s][key] is not None]
 
         if files == []:
             raise Exception("No files for given subjects")
@@ -90,66 +443,139 @@ class DataContainer():
 
     def path_from_code(self, code, cleaned=False):
         if cleaned:
-            return os.path.join(self.cleaned, f"{code}.json")
+            return os.path.join(self.cleaned, f"{code}{CLEANED_FORMATS[self.cleaned_format]}")
         else:
-            return os.path.join(self.raw, f"{code}.json")
+            return os.path.join(self.raw, f"{code}{RAW_COMPRESSIONS[self.raw_compression]}")
 
     def get_subject_codes(self, cleaned=False):
-        return [self.code_from_path(f) for f in self.get_session_logs(cleaned=cleaned)]
+        key = "cleaned" if cleaned else "raw"
+        return [code for code, entry in self.manifest.items() if entry[key] is not None]
 
     def get_session_logs(self, cleaned=False):
-        base_path = self.cleaned if cleaned else self.raw
-        return glob(os.path.join(base_path, "*.json"))
+        key = "cleaned" if cleaned else "raw"
+        return [entry[key] for entry in self.manifest.values() if entry[key] is not None]
+
+    def get_stale_subjects(self, force=False):
+        '''
+        Works out which subjects need cleaning from the manifest alone, without parsing any
+        session logs. A subject is stale if it has no cleaned file, or if its raw file was
+        written after its cleaned file.
+
+        :param force: treat every subject as stale
+        :return: list of subject codes, in manifest order
+        '''
+        return [code for code, entry in self.manifest.items()
+                if entry["raw"] is not None
+                and (force or entry["status"] in ("raw", "stale"))]
 
     def get_raw_data(self, subjects=None):
-        if not subjects == None \
+        return list(self.iter_raw_data(subjects))
+
+    def iter_raw_data(self, subjects=None):
+        '''
+        Lazily parses raw session logs one at a time, so that memory use is bounded by
+        the largest session rather than the size of the experiment. If subjects are
+        given, sessions are yielded in the same order as subjects.
+        '''
+        if not subjects is None \
            and not isinstance(subjects, list) \
            and not isinstance(subjects, tuple):
             subjects = [subjects]
 
-        files = self.get_session_logs(cleaned=False)
-
-        if not subjects == None:
-            files = self.filter_files_by_subject(files, subjects)
+        if subjects is None:
+            subjects = self.get_subject_codes(cleaned=False)
+        elif len(subjects) == 0:
+            return
+        else:
+            # fail before parsing anything if subjects are missing
+            self.get_subject_files(subjects)
 
-        return [self.read_session_log(f) for f in files]
+        for code in subjects:
+            yield self.read_session(code)
 
-    def get_cleaned_data(self, subjects=None):
+    @property
+    def event_schema(self):
+        return get_event_schema(self.experiment)
+
+    def get_cleaned_data(self, subjects=None, columns=None, where=None, typed=True):
+        '''
+        Loads cleaned events for subjects, or all subjects that aren't excluded.
+
+        :param columns: list of columns to load, defaults to all columns
+        :param where: list of (column, op, value) row filters that must all hold, with op one
+                      of FILTER_OPS, e.g. [("type", "in", ["WORD"]), ("listno", ">=", 3)]. For
+                      parquet, columns and filters are applied while reading.
+        :param typed: cast columns to the experiment's event schema. Categories don't survive
+                      concatenating subjects, so this is done after concatenating.
+        '''
         # TODO: catch error to note whether not cleaned data is available
 
+        if where is not None:
+            for _, op, _ in where:
+                if op not in FILTER_OPS:
+                    raise ValueError(f"Filter op must be one of {list(FILTER_OPS)}, not {op}")
+
         if not subjects is None \
            and not isinstance(subjects, list) \
            and not isinstance(subjects, tuple):
             subjects = [subjects]
 
-        files = self.get_session_logs(cleaned=True)
+        # subjects cleaned since the dataset was last consolidated are read from their own files
+        if self.use_consolidated and self.consolidated_is_current():
+            data = self.read_consolidated(subjects, columns=columns, where=where)
+            return apply_schema(data, self.event_schema) if typed else data
 
         if not subjects is None:
-            files = self.filter_files_by_subject(files, subjects)
+            files = self.get_subject_files(subjects, cleaned=True)
         else:
-            files = [f for f in files if os.path.basename(f).split('.')[0] not in self.get_bad_subs()]
+            bad_subs = self.get_bad_subs()
+            files = [entry["cleaned"] for code, entry in self.manifest.items()
+                     if entry["cleaned"] is not None and code not in bad_subs]
+
+        all_data = [self.read_df(f, columns=columns, where=where) for f in files]
+
+        data = pd.concat(all_data)
 
-        all_data = []
-        for f in files:
-            with open(f, 'r') as f:
-                all_data.append(pd.read_json(f))
-        
-        return pd.concat(all_data) 
+        return apply_schema(data, self.event_schema) if typed else data
+
+    def memory_report(self, subjects=None):
+        '''
+        Reports the memory used by each column of cleaned events before and after casting
+        to the event schema. Cleaned data saved as json is loaded untyped, so this shows the
+        savings over plain pandas dtypes.
+        '''
+        return memory_report(self.get_cleaned_data(subjects, typed=False), self.event_schema)
 
     def record_collection(self, subjects: list, fname: str):
+        '''
+        Adds subjects to a collection file. The file is only appended to, under an exclusive
+        lock, so concurrent runs can record subjects without losing each other's writes.
+        '''
         path = os.path.join(self.root, self.experiment, f"{fname}.txt")
-        subjects = set(subjects)
 
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                exists = set(s.strip() for s in f.readlines())
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
 
-            union = list(exists | subjects)
-        else:
-            union = subjects
+            f.seek(0)
+            contents = f.read()
+            exists = set(s.strip() for s in contents.splitlines())
+
+            new = [s for s in dict.fromkeys(subjects) if s not in exists]
 
-        with open(path, 'w') as f:
-            f.write("\n".join(union))
+            if new:
+                # files written before appending was used don't end with a newline
+                if contents and not contents.endswith("\n"):
+                    f.write("\n")
+
+                f.write("\n".join(new) + "\n")
+                f.flush()
+
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        if self._manifest is not None:
+            bad_subs = self.get_bad_subs()
+            for entry in self._manifest.values():
+                self._update_status(entry, bad_subs)
 
     def record_excluded(self, subjects: list):
         self.record_collection(subjects, "EXCLUDED")
@@ -158,16 +584,202 @@ class DataContainer():
         self.record_collection(subjects, "WROTE_NOTES")
 
     def read_collection(self, fname: str):
+        '''
+        :return: frozenset of subjects in a collection. Collections are cached until their
+                 file's size or modification time changes.
+        '''
         path = os.path.join(self.root, self.experiment, f"{fname}.txt")
-        if os.path.exists(path):
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return frozenset()
+
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        if fname not in self._collections or self._collections[fname][0] != version:
             with open(path, 'r') as f:
-                subs = set(s.strip() for s in f.readlines())
-            return subs
-        else:
-            return set()
+                fcntl.flock(f, fcntl.LOCK_SH)
+                subs = frozenset(s.strip() for s in f.read().splitlines()) - {""}
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+            self._collections[fname] = (version, subs)
+
+        return self._collections[fname][1]
 
     def save_df(self, df, subject):
-        df.to_json(self.path_from_code(subject, cleaned=True))
+        path = self.path_from_code(subject, cleaned=True)
+        df = apply_schema(df, self.event_schema)
+
+        if self.cleaned_format == "parquet":
+            self._arrow_compatible(df).to_parquet(path)
+        elif self.cleaned_format == "feather":
+            # feather can't store an index, cleaned events are saved with a default one
+            self._arrow_compatible(df).reset_index(drop=True).to_feather(path)
+        else:
+            df.to_json(path)
+
+        # cleaned files in other formats are replaced, so that experiments are only ever read
+        # in one format
+        for cleaned_format, ext in CLEANED_FORMATS.items():
+            other = os.path.join(self.cleaned, f"{subject}{ext}")
+            if cleaned_format != self.cleaned_format and os.path.exists(other):
+                os.remove(other)
+
+        if self._manifest is not None:
+            entry = self._manifest.setdefault(subject, {"code": subject, "raw": None, "size": None, "mtime": None, "hash": None})
+            entry.update(cleaned=path, cleaned_mtime=os.path.getmtime(path))
+            self._update_status(entry, self.get_bad_subs())
+
+    def read_df(self, path, columns=None, where=None):
+        if self.cleaned_format == "parquet":
+            return pd.read_parquet(path, columns=columns, filters=where or None)
+
+        read_columns = _read_columns(columns, where)
+
+        if self.cleaned_format == "feather":
+            df = pd.read_feather(path, columns=read_columns)
+        else:
+            with open(path, 'r') as f:
+                df = pd.read_json(f)
+
+        if where:
+            df = filter_rows(df, where)
+
+        return df if columns is None else df[list(columns)]
+
+    # The consolidated dataset is a directory of parquet fragments, one per subject, along with
+    # _common_metadata, holding the schema every fragment is read as, and _index.json, mapping
+    # subject codes to the modification time of the cleaned file each fragment was written from.
+
+    def consolidated_fragment(self, code):
+        return os.path.join(self.consolidated, f"{code}.parquet")
+
+    def consolidated_index(self):
+        '''
+        :return: dict of subject code to the modification time of the cleaned file its fragment
+                 was written from, empty if there isn't a consolidated dataset
+        '''
+        path = os.path.join(self.consolidated, "_index.json")
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def consolidated_is_current(self):
+        '''
+        :return: whether the consolidated dataset exists and holds the current cleaned events
+                 of every cleaned subject
+        '''
+        index = self.consolidated_index()
+        cleaned = {code: entry["cleaned_mtime"] for code, entry in self.manifest.items() if entry["cleaned"] is not None}
+
+        return bool(index) and index == cleaned
+
+    def consolidate(self):
+        '''
+        Updates the consolidated dataset. Only subjects whose cleaned file changed since the
+        last update are decoded and written, fragments of subjects that no longer have a
+        cleaned file are removed, and nothing is written if the dataset is current.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        files = {code: entry["cleaned"] for code, entry in self.manifest.items() if entry["cleaned"] is not None}
+        index = self.consolidated_index()
+
+        stale = [s for s in sorted(files) if index.get(s) != self.manifest[s]["cleaned_mtime"]]
+        removed = [s for s in index if s not in files]
+
+        if not stale and not removed and index:
+            return
+
+        # datasets from before fragments were used are single files, and are rebuilt
+        if os.path.isfile(self.consolidated):
+            os.remove(self.consolidated)
+
+        os.makedirs(self.consolidated, exist_ok=True)
+
+        for subject in stale:
+            table = pa.Table.from_pandas(self._arrow_compatible(self.read_df(files[subject])), preserve_index=False)
+
+            tmp = f"{self.consolidated_fragment(subject)}.tmp"
+            pq.write_table(table, tmp)
+            os.replace(tmp, self.consolidated_fragment(subject))
+
+        for subject in removed:
+            os.remove(self.consolidated_fragment(subject))
+
+        # types can differ between subjects, so fragments are read as one schema settled from
+        # all of their footers
+        schema = _unify_schemas([pq.read_schema(self.consolidated_fragment(s)) for s in sorted(files)])
+
+        tmp = os.path.join(self.consolidated, "_common_metadata.tmp")
+        pq.write_metadata(schema, tmp)
+        os.replace(tmp, os.path.join(self.consolidated, "_common_metadata"))
+
+        # the index is written last, so an interrupted update is redone on the next run
+        tmp = os.path.join(self.consolidated, "_index.json.tmp")
+        with open(tmp, 'w') as f:
+            json.dump({s: self.manifest[s]["cleaned_mtime"] for s in sorted(files)}, f)
+        os.replace(tmp, os.path.join(self.consolidated, "_index.json"))
+
+    def read_consolidated(self, subjects=None, columns=None, where=None):
+        '''
+        Reads subjects from the consolidated dataset, only decoding their fragments.
+        Arguments are as for get_cleaned_data.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        index = self.consolidated_index()
+
+        if subjects is None:
+            bad_subs = self.get_bad_subs()
+            subjects = [s for s in index if s not in bad_subs]
+        elif any(s not in index for s in subjects):
+            raise Exception("Files do not match subjects")
+
+        schema = pq.read_schema(os.path.join(self.consolidated, "_common_metadata"))
+        read_columns = _read_columns(columns, where)
+        if read_columns is not None:
+            schema = pa.schema([schema.field(col) for col in read_columns])
+
+        tables = []
+        for subject in subjects:
+            with pq.ParquetFile(self.consolidated_fragment(subject)) as f:
+                # columns missing from a fragment are filled in by _conform
+                table = f.read(columns=[col for col in schema.names if col in f.schema_arrow.names])
+
+            tables.append(_conform(table, schema))
+
+        df = pa.concat_tables(tables).to_pandas() if tables else schema.empty_table().to_pandas()
+
+        if where:
+            df = filter_rows(df, where)
+
+        return df if columns is None else df[list(columns)]
+
+    @staticmethod
+    def _arrow_compatible(df):
+        '''
+        Arrow needs string column names and a single type per column. Columns built
+        from jsPsych responses can mix types, so those are stored as strings, leaving
+        missing values missing.
+        '''
+        import pyarrow as pa
+
+        df = df.rename(columns=str)
+
+        for col in df.columns[df.dtypes == object]:
+            try:
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+
+        return df
 
     def get_bad_subs(self, bad_collections: list = ["EXCLUDED", "WROTE_NOTES"]):
         return reduce(lambda a, b: a | b, map(self.read_collection, bad_collections))
@@ -0,0 +1,157 @@
+import gzip
+import json
+import os
+from contextlib import contextmanager
+
+# orjson is much faster on large datastrings, msgpack is needed to cache decoded
+# sessions, and zstandard to read and write .json.zst raw files, but all are optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BACKEND = "json" if orjson is None else "orjson"
+
+# top level fields psiTurk stores as json encoded strings
+DOUBLE_ENCODED = ("datastring",)
+
+# any other field is only decoded if it could be json, which saves raising and catching
+# an exception for every plain string. stdlib json also accepts NaN, Infinity, and
+# -Infinity, and skips leading whitespace.
+JSON_STARTS = frozenset('"{[-0123456789tfnNI')
+JSON_WHITESPACE = " \t\n\r"
+
+
+def loads(s):
+    '''
+    Decodes json with the fastest available backend. orjson is stricter than stdlib json,
+    e.g. rejecting NaN, so anything it rejects is decoded again with stdlib json to give
+    the same result either way.
+    '''
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(s)
+
+
+@contextmanager
+def open_raw(path, mode='rb'):
+    '''
+    Opens a raw session log as a binary stream, compressing or decompressing .json.gz and
+    .json.zst files on the fly.
+
+    :param mode: 'rb' or 'wb'
+    '''
+    if path.endswith(".gz"):
+        with gzip.open(path, mode) as f:
+            yield f
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"zstandard is needed for {path}")
+
+        with open(path, mode) as fh:
+            if 'r' in mode:
+                with zstandard.ZstdDecompressor().stream_reader(fh) as f:
+                    yield f
+            else:
+                with zstandard.ZstdCompressor().stream_writer(fh) as f:
+                    yield f
+    else:
+        with open(path, mode) as f:
+            yield f
+
+
+def load(path):
+    with open_raw(path) as f:
+        return loads(f.read())
+
+
+def decode_session(raw):
+    '''
+    Decodes fields of a psiTurk session that are themselves json strings, in place.
+    Fields that aren't valid json are left as they are.
+
+    :param raw: session dictionary, as loaded from a raw session log
+    :return: raw
+    '''
+    for key, value in raw.items():
+        if not isinstance(value, str):
+            continue
+
+        if key in DOUBLE_ENCODED:
+            decode = loads
+        elif value.lstrip(JSON_WHITESPACE)[:1] in JSON_STARTS:
+            decode = json.loads
+        else:
+            continue
+
+        try:
+            raw[key] = decode(value)
+        except ValueError:
+            continue
+
+    return raw
+
+
+def read_cached_session(path):
+    '''
+    Reads a decoded session from a msgpack sidecar file, which starts with a header
+    identifying the version of the raw file it was decoded from, with the raw file's
+    "size", "mtime_ns", and content "hash".
+
+    :return: (header, decoded session), or (None, None) if there's no sidecar
+    '''
+    if msgpack is None or not os.path.exists(path):
+        return None, None
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    unpacker = msgpack.Unpacker(raw=False, strict_map_key=False, max_buffer_size=len(data))
+    unpacker.feed(data)
+
+    try:
+        header = next(unpacker)
+        if not isinstance(header, dict):
+            # sidecars from before headers were used
+            return None, None
+
+        return header, next(unpacker)
+    except (StopIteration, ValueError):
+        # truncated or corrupt sidecars are treated as missing
+        return None, None
+
+
+def write_cached_session(path, header, raw):
+    '''
+    Writes a decoded session to a msgpack sidecar file. Sessions that msgpack can't
+    represent, e.g. with integers over 64 bits, aren't cached.
+
+    :param header: dict identifying the version of the raw file, as for read_cached_session
+    '''
+    if msgpack is None:
+        return
+
+    try:
+        data = msgpack.packb(header) + msgpack.packb(raw)
+    except (TypeError, ValueError, OverflowError):
+        return
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+
+    os.replace(tmp, path)
@@ -7,9 +7,16 @@ parser.add_argument("experiment", help='The name of the experiment. If db_path i
 parser.add_argument("data_root", help='Root directory from which all data destination paths are referenced.')
 parser.add_argument("--db_path", default=None, help="Path to experiment database, needed if data is not already extracted and anonymized. This path should be formatted as a URI, with file:/// prepended to both relative and absolute paths.")
 parser.add_argument("--force", action='store_true', default=False, help='Overwrite existing files')
+parser.add_argument("--full", action='store_true', default=False, help="Query every participant in the database, rather than only those who finished since the last extraction. Implied by --force.")
 parser.add_argument("--verbose", action='store_true', default=False, help="Add this switch to increase the amount of output during processing, including errors.")
 parser.add_argument("--no-reports", action='store_true', default=False, help="Add this switch to prevent reports from being run.")
 parser.add_argument("--no-events", action='store_true', default=False, help="Add this switch to prevent events from being run.")
+parser.add_argument("--dry-run", action='store_true', default=False, help="Add this switch to print the subjects that would be cleaned and an estimate of the work, without extracting, cleaning, or reporting.")
+parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes used to clean subject data. Defaults to cleaning in a single process.")
+parser.add_argument("--cleaned-format", default=None, choices=["json", "parquet", "feather"], help="File format for cleaned event data. Parquet and feather keep column types and are much faster to load than json. Defaults to the format the experiment was cleaned in, or json for new experiments. Giving another format converts the experiment, re-cleaning every subject.")
+parser.add_argument("--consolidate", action='store_true', default=False, help="Add this switch to keep a parquet dataset of all cleaned subjects, with one fragment per subject, updated after cleaning and used when loading cleaned data.")
+parser.add_argument("--no-session-cache", action='store_true', default=False, help="Add this switch to always parse raw json, rather than reading decoded sessions cached from previous runs.")
+parser.add_argument("--raw-compression", default=None, choices=["gzip", "zstd"], help="Compress raw data extracted from the database. Raw data is read in any compression regardless.")
 args = parser.parse_args()
 
 exp = args.experiment
@@ -23,6 +30,10 @@ paths_dict["db"] = args.db_path
 paths_dict["dictionary"] = 'dictionary.txt'
 paths_dict["wordpool"] = 'wordpool.txt'
 paths_dict["class_exp"] = 'class_' in exp
+paths_dict["cleaned_format"] = args.cleaned_format
+paths_dict["consolidated"] = args.consolidate
+paths_dict["session_cache"] = not args.no_session_cache
+paths_dict["raw_compression"] = args.raw_compression
 
 # Process json into pandas dataframe structures
 data_container = DataContainer(**paths_dict)
@@ -31,14 +42,14 @@ if args.force:
     print("Forcing event cleaning")
 
 # Load the data from the psiTurk experiment database and process it into JSON files
-if args.db_path is not None:
-    psiturk_tools.load_psiturk_data(data_container, force=args.force, verbose=args.verbose)
+if args.db_path is not None and not args.dry_run:
+    psiturk_tools.load_psiturk_data(data_container, force=args.force, verbose=args.verbose, full=args.full)
 
 if not args.no_events:
     data_cleaner = get_cleaner(data_container)
-    data_cleaner.clean(force=args.force, verbose=args.verbose)
+    data_cleaner.clean(force=args.force, verbose=args.verbose, jobs=args.jobs, dry_run=args.dry_run)
 
-if not args.no_reports:
+if not args.no_reports and not args.dry_run:
     # Generate a PDF report for each participant, along with an aggregate report and summary stats files
     report_generator = get_reporter(data_container)
     report_generator.run_reporting()
@@ -1,22 +1,33 @@
-import os
 import json
+import datetime
 import numpy as np
 import pandas as pd
 from glob import glob
 # FIXME
 from worker_management import DBManager
+from post_process.scrubbing import Scrubber
 
-def anonymize_row(row, workerid, anonymousid):
+def anonymize_row(row, scrubber):
+    """
+    Removes the ip address from a row, and replaces worker ids with anonymous ids and assignment and HIT ids with
+    placeholders, in the identifier columns and datastring.
+
+    :param scrubber: Scrubber built with the ids of this row, e.g. along with the rest of its batch
+    :return: (row, number of replacements made), which should be at least one per identifier column
+    """
     # remove ip
-    row.ip = "XX.XXX.XXX.XX"
-    row.workerid = anonymousid
-    row.uniqueid = row.uniqueid.replace(workerid, anonymousid)
-    row.datastring = row.datastring.replace(workerid, anonymousid)
+    row.ipaddress = "XX.XXX.XXX.XX"
+
+    replacements = 0
+    for column in ["workerid", "uniqueid", "assignmentid", "hitid", "datastring"]:
+        value, n = scrubber.subn(getattr(row, column))
+        setattr(row, column, value)
+        replacements += n
 
-    return row
+    return row, replacements
 
 
-def load_psiturk_data(data_container, force=False, verbose=False):
+def load_psiturk_data(data_container, force=False, verbose=False, full=False):
     """
     Extracts the data from each participant in a psiTurk study, then writes as a JSON file for each participant.
 
@@ -28,6 +39,9 @@ def load_psiturk_data(data_container, force=False, verbose=False):
     default, psiTurk labels this column as 'datastring'
     :param force: If False, only write JSON files for participants that don't already have a JSON file. If True, create
     JSON files for all participants. (Default == False)
+    :param full: If False, only query participants who finished since the last extraction, as recorded in the
+    experiment's watermark. If True, query all participants. Implied by force. (Default == False)
+    :return: dict of subject code to the number of identifiers replaced in their row, for auditing
     """
 
     """
@@ -42,28 +56,80 @@ def load_psiturk_data(data_container, force=False, verbose=False):
     BONUSED = 7
     """
 
-    # Use sqlalchemy to load rows from specified table in the specified database
+    # Use sqlalchemy to load rows from specified table in the specified database, along with
+    # anonymous ids, in one session
     with DBManager(data_container.db, verbose_sql=False) as db:
         if not data_container.class_exp:
             db.add_workers_from_experiment(data_container.experiment)
-        complete_subs = db.get_complete_subjects(data_container.experiment, class_exp=data_container.class_exp)
 
-    for row in complete_subs:
+        since, seen = None, set()
+        watermark = None if (full or force) else data_container.read_watermark()
+        if watermark is not None:
+            since = None if watermark["endhit"] is None else datetime.date.fromisoformat(watermark["endhit"])
+            seen = set(watermark["uniqueids"])
+
+        # work out which subjects need writing from their ids alone, so that
+        # datastrings are only loaded for those subjects
+        to_write = []
+        anonymous_ids, other_ids = {}, set()
+        extracted, skipped = [], []
+        for uniqueid, workerid, assignmentid, hitid, anonymousid, endhit in db.get_complete_subject_ids(data_container.experiment, class_exp=data_container.class_exp, since=since):
+
+            if uniqueid in seen:
+                extracted.append((uniqueid, endhit))
+                continue
+
+            if data_container.class_exp:
+                subj_id = workerid
+            else:
+                # Get subject ID
+                subj_id = anonymousid
+
+            if subj_id is None:
+                if verbose:
+                    print(f"No anonymous id for {uniqueid}, skipping")
+                skipped.append(endhit)
+                continue
+
+            extracted.append((uniqueid, endhit))
+
+            # Only attempt to write a JSON file if the participant has data and does not already have a JSON file,
+            # in any compression
+            if force or data_container.manifest.get(subj_id, {}).get("raw") is None:
+                to_write.append(uniqueid)
+                anonymous_ids[workerid] = subj_id
+                other_ids.update([assignmentid, hitid])
+
+        # one scrubber for every id being written, so each datastring is only scanned once
+        scrubber = Scrubber.from_ids(anonymous_ids, other_ids)
+        audit = {}
+
+        # rows are detached as they're streamed, so anonymizing them in place never
+        # changes the database
+        for row, anonymousid in db.iter_subjects(data_container.experiment, to_write):
+            subj_id = row.workerid if data_container.class_exp else anonymousid
+
+            row, audit[subj_id] = anonymize_row(row, scrubber)
+            data_container.write_session_log(row.as_dict(), subj_id)
+
+            if verbose:
+                print(f"{subj_id}: replaced {audit[subj_id]} identifiers")
+
+    # the watermark never moves past skipped subjects, so they're extracted once they have
+    # an anonymous id. subjects on the watermark are remembered, since end dates are only days
+    endhits = [endhit for _, endhit in extracted if endhit is not None]
+    skipped = [endhit for endhit in skipped if endhit is not None]
+    watermark_endhit = max(endhits) if endhits else since
+    if skipped and (watermark_endhit is None or min(skipped) < watermark_endhit):
+        watermark_endhit = min(skipped)
 
-        if data_container.class_exp:
-            subj_id = row.workerid
-        else:
-            # Get subject ID
-            with DBManager(data_container.db) as db:
-                subj_id = db.get_anonymous_id(row.workerid)
+    data_container.write_watermark({"endhit": None if watermark_endhit is None else watermark_endhit.isoformat(),
+                                    "uniqueids": sorted(uniqueid for uniqueid, endhit in extracted
+                                                        if endhit is None or watermark_endhit is None or endhit >= watermark_endhit)})
 
-        row = anonymize_row(row, row.workerid, subj_id)
-        datafile_path = data_container.path_from_code(subj_id)
+    data_container.refresh_manifest()
 
-        # Only attempt to write a JSON file if the participant has data and does not already have a JSON file
-        if force or not os.path.exists(datafile_path):
-            with open(datafile_path, 'w') as f:
-                json.dump(row.as_dict(), f)
+    return audit
 
 def _read_raw_json(files):
     all_data = []
@@ -12,7 +12,9 @@ class OrderedRecallReport(BaseReporter):
     def generate_report(self, subject):
         report = Report(f"{subject} - Ordered Recall")
 
-        data = self.data_container.get_cleaned_data(subject).query("type in ['WORD'] and listno >= 3")
+        data = self.data_container.get_cleaned_data(subject,
+                                                    columns=["listno", "length", "serialpos", "rt", "recalled", "correct", "distance", "condition"],
+                                                    where=[("type", "in", ["WORD"]), ("listno", ">=", 3)])
 
         pivot = data.pivot_table(index=['listno', 'length'], \
                          columns='serialpos',                   \
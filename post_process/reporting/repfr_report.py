@@ -13,15 +13,17 @@ class RepFRReport(BaseReporter):
 
     def generate_report(self, subject):
         report = Report(f"{subject} - RepFR")
-        data = self.data_container.get_cleaned_data(subject)
+        data = self.data_container.get_cleaned_data(subject,
+                                                    columns=["subject", "repeats", "serialpos", "recalled"],
+                                                    where=[("type", "==", "WORD")])
 
-        recalls_by_repeat = data[data.type == 'WORD'].groupby(["repeats", "serialpos"]).recalled.mean()
+        recalls_by_repeat = data.groupby(["repeats", "serialpos"]).recalled.mean()
 
         new_index = pd.MultiIndex.from_product(recalls_by_repeat.index.levels)
         recalls_by_repeat = recalls_by_repeat.reindex(new_index)
         recalls_by_repeat = recalls_by_repeat.fillna(np.nan)
 
-        recall_prop = data[data.type == 'WORD'].query("4 <= serialpos <= 24").groupby(["subject", "repeats"]).recalled.mean()
+        recall_prop = data.query("4 <= serialpos <= 24").groupby(["subject", "repeats"]).recalled.mean()
 
         fig = px.histogram(recall_prop.reset_index(), x='repeats', y='recalled') \
                 .to_html(full_html=False, include_plotlyjs=False)
@@ -10,7 +10,9 @@ class SerialRecallReport(BaseReporter):
 
     def generate_report(self, subject):
         report = Report(f"{subject} - Serial Recall")
-        data = self.data_container.get_cleaned_data(subject) 
+        data = self.data_container.get_cleaned_data(subject,
+                                                    columns=["type", "listno", "serialpos", "recalled"],
+                                                    where=[("type", "in", ["WORD", "REC_WORD"])])
 
         # generate spc
         beh_mat = data.loc[data["type"] == 'REC_WORD'].groupby("listno").serialpos.apply(np.array)
@@ -0,0 +1,80 @@
+import pandas as pd
+
+# Dtypes of cleaned event columns. Without these, strings are stored as python objects
+# and integer fields as float64, since modifiers fill them in with .loc on a subset
+# of rows. Columns that aren't present in a frame are skipped.
+
+COMMON_SCHEMA = {"type": "category",
+                 "item": "category",
+                 "subject": "category",
+                 "condition": "category",
+                 "counterbalance": "Int16",
+                 "listno": "Int16",
+                 "serialpos": "Int16",
+                 "itemno": "Int32"}
+
+FREE_RECALL_SCHEMA = {**COMMON_SCHEMA,
+                      "recalled": "boolean",
+                      "recalled_serialpos": "Int16",
+                      "intrusion": "Int16",
+                      "pli": "boolean",
+                      "pli_lag": "Int16"}
+
+EVENT_SCHEMAS = {"serial_recall_2": FREE_RECALL_SCHEMA,
+                 "class_srv2": FREE_RECALL_SCHEMA,
+                 "presrate": FREE_RECALL_SCHEMA,
+                 "repFR": {**FREE_RECALL_SCHEMA,
+                           "repeats": "Int16",
+                           "is_repeat": "boolean"},
+                 # recalled is the serial position an item was recalled at
+                 "ordered_recall": {**COMMON_SCHEMA,
+                                    "recalled": "Int16",
+                                    "correct": "Int16",
+                                    "distance": "Int16",
+                                    "relative_correct": "boolean"}}
+
+
+def get_event_schema(experiment):
+    return EVENT_SCHEMAS.get(experiment, COMMON_SCHEMA)
+
+
+def apply_schema(df, schema):
+    '''
+    Casts columns of an events frame to the dtypes in schema. Columns that can't be
+    cast losslessly, e.g. with fractional values in an integer column, are left as
+    they are.
+
+    :return: new dataframe
+    '''
+    df = df.copy()
+
+    for col, dtype in schema.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+
+        try:
+            df[col] = df[col].astype(dtype)
+        except (TypeError, ValueError):
+            continue
+
+    return df
+
+
+def memory_report(df, schema):
+    '''
+    Compares the memory used by each column of an events frame before and after
+    applying schema.
+
+    :return: dataframe indexed by column, with a total row
+    '''
+    typed = apply_schema(df, schema)
+
+    report = pd.DataFrame({"dtype": df.dtypes.astype(str),
+                           "bytes": df.memory_usage(deep=True, index=False),
+                           "schema_dtype": typed.dtypes.astype(str),
+                           "schema_bytes": typed.memory_usage(deep=True, index=False)})
+
+    report.loc["total"] = ["", report["bytes"].sum(), "", report["schema_bytes"].sum()]
+    report["savings"] = 1 - report["schema_bytes"] / report["bytes"]
+
+    return report
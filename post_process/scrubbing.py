@@ -0,0 +1,76 @@
+import re
+
+# Identifiers are scrubbed with one regex compiled from a trie of every identifier in a
+# batch of rows, e.g. A1B2:(?:C3|D4(?:E5)?), so each string is scanned once however many
+# identifiers there are, and the pattern branches on shared prefixes rather than trying
+# every identifier at every position. Where identifiers overlap, the longest one is replaced.
+
+
+def trie_pattern(words):
+    '''
+    :return: regex source matching any of words, preferring longer matches
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+
+    if not branches:
+        return ""
+
+    pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+
+    # a word ends here, so the rest is optional. ? is greedy, so longer words still match first
+    if "" in node:
+        return f"(?:{pattern})?"
+
+    return pattern
+
+
+def placeholder(identifier):
+    return "X" * len(identifier)
+
+
+class Scrubber:
+    '''
+    Replaces identifiers in strings with their anonymized replacements, in a single pass
+    over each string.
+
+    :param replacements: dict of identifier to replacement. Empty identifiers are ignored.
+    '''
+
+    def __init__(self, replacements):
+        self.replacements = {k: v for k, v in replacements.items() if k}
+        self.pattern = re.compile(trie_pattern(self.replacements)) if self.replacements else None
+
+    def _replace(self, match):
+        return self.replacements[match.group(0)]
+
+    def subn(self, text):
+        '''
+        :return: (scrubbed text, number of replacements made)
+        '''
+        if self.pattern is None or not text:
+            return text, 0
+
+        return self.pattern.subn(self._replace, text)
+
+    @classmethod
+    def from_ids(cls, workers, others=()):
+        '''
+        :param workers: dict of worker id to anonymous id
+        :param others: other identifiers, e.g. assignment and HIT ids, replaced by placeholders
+        '''
+        replacements = {identifier: placeholder(identifier) for identifier in others if identifier}
+        # worker ids take precedence over placeholders for the same string
+        replacements.update(workers)
+
+        return cls(replacements)
@@ -0,0 +1,120 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+from collections import namedtuple
+import numpy as np
+
+# Word lists are compiled next to their source text, into <source>.compiled/, as
+#   words.npy   fixed width unicode array of words, in source order
+#   counts.npy  character counts of each word, as used by SpellingIndex
+#   meta.json   size and modification time of the source, how it was parsed, and a
+#               hash of the words
+# Arrays are memory mapped, so every process cleaning data shares one copy of them.
+
+WordList = namedtuple("WordList", ["words", "counts", "hash"])
+
+
+def parse_wordlist(text, lines=True):
+    '''
+    :param lines: one word per line, keeping blank lines, rather than whitespace separated
+    '''
+    return [w.strip().upper() for w in (io.StringIO(text).readlines() if lines else text.split())]
+
+
+def words_hash(words):
+    return hashlib.sha1("\n".join(words).encode()).hexdigest()
+
+
+def compiled_path(source):
+    return f"{source}.compiled"
+
+
+def load_compiled(source, lines=True):
+    '''
+    :return: memory mapped WordList, or None if source hasn't been compiled the same way
+             since it changed
+    '''
+    out = compiled_path(source)
+
+    try:
+        with open(os.path.join(out, "meta.json"), 'r') as f:
+            meta = json.load(f)
+
+        stat = os.stat(source)
+        if (meta["size"], meta["mtime_ns"], meta["lines"]) != (stat.st_size, stat.st_mtime_ns, lines):
+            return None
+
+        return WordList(np.load(os.path.join(out, "words.npy"), mmap_mode='r'),
+                        np.load(os.path.join(out, "counts.npy"), mmap_mode='r'),
+                        meta["hash"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def compile_wordlist(source, words, lines=True):
+    '''
+    Compiles words parsed from source, as by parse_wordlist with lines. If the compiled
+    files can't be written, e.g. for a read only install, the word list is returned
+    without being saved.
+
+    :return: WordList, memory mapped if it was saved
+    '''
+    from post_process.cleaning.spelling import char_counts
+
+    words = list(words)
+    compiled = WordList(np.array(words, dtype=str), char_counts(words), words_hash(words))
+
+    out = compiled_path(source)
+    stat = os.stat(source)
+
+    try:
+        os.makedirs(out, exist_ok=True)
+
+        # write to temporary files first, so that concurrent processes never map a partial array
+        for name, array in [("words", compiled.words), ("counts", compiled.counts)]:
+            tmp = os.path.join(out, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(out, f"{name}.npy"))
+
+        tmp = os.path.join(out, f"meta.{os.getpid()}.tmp.json")
+        with open(tmp, 'w') as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "lines": lines, "hash": compiled.hash}, f)
+        os.replace(tmp, os.path.join(out, "meta.json"))
+    except OSError:
+        return compiled
+
+    return load_compiled(source, lines=lines) or compiled
+
+
+def get_wordlist(source, lines=True):
+    '''
+    Loads a compiled word list, compiling it first if source has changed.
+    '''
+    compiled = load_compiled(source, lines=lines)
+
+    if compiled is None:
+        with open(source, 'r') as f:
+            compiled = compile_wordlist(source, parse_wordlist(f.read(), lines=lines), lines=lines)
+
+    return compiled
+
+
+if __name__ == "__main__":
+    # build step, run after installing or updating word lists
+    parser = argparse.ArgumentParser(description="Compile word lists for memory mapping.")
+    parser.add_argument("sources", nargs="*", help="Word list files with one word per line. Defaults to the packaged dictionary.")
+    args = parser.parse_args()
+
+    import importlib.resources as pkg_resources
+    import post_process.resources as resources
+
+    if args.sources:
+        for source in args.sources:
+            get_wordlist(source)
+            print(f"Compiled {source}")
+    else:
+        with pkg_resources.path(resources, 'webster_dictionary.txt') as source:
+            get_wordlist(str(source), lines=False)
+            print(f"Compiled {source}")
@@ -66,6 +66,10 @@ class AcceptanceTracker(Base):
     excluded = sql.Column(sql.Boolean, nullable=False, default=False)
     experiment = sql.Column(sql.String(128))
 
+def format_anonymous_id(anonymousid):
+    return f"MTK{anonymousid:05d}"
+
+
 def get_class_by_tablename(tablename):
     """Return class reference mapped to table.
 
@@ -107,19 +111,75 @@ class DBManager(object):
         self.session = None
 
 
-    def get_complete_subjects(self, experiment, class_exp=False):
+    @staticmethod
+    def complete_filter(TableClass, class_exp=False):
         if class_exp:
             complete_statuses=[2, 3, 4, 5, 7]
             modes = ["prolific", "live", "debug"]
         else:
             complete_statuses=[3, 4, 5, 7]
             modes = ["prolific", "live"]
+
+        return sql.and_(TableClass.status.in_(complete_statuses), TableClass.mode.in_(modes))
+
+
+    def get_complete_subjects(self, experiment, class_exp=False):
         TableClass = get_class_by_tablename(experiment)
-        rows = self.session.query(TableClass).filter(sql.and_(TableClass.status.in_(complete_statuses),\
-                                                         TableClass.mode.in_(modes))).all()
+        rows = self.session.query(TableClass).filter(self.complete_filter(TableClass, class_exp)).all()
         return rows
 
 
+    def get_complete_subject_ids(self, experiment, class_exp=False, since=None):
+        '''
+        Gets the ids of complete subjects without loading their datastrings, e.g. to work out
+        which subjects need to be loaded with iter_subjects. Anonymous ids come from the same
+        joined query, rather than a query per subject.
+
+        :param since: if given, only get subjects who finished on or after this date, along with
+                      any without an end date
+        :return: list of (uniqueid, workerid, assignmentid, hitid, anonymousid, endhit) tuples, with
+                 anonymousid formatted as by get_anonymous_id, or None for workers not in the
+                 master list
+        '''
+        TableClass = get_class_by_tablename(experiment)
+        query = self.session.query(TableClass.uniqueid, TableClass.workerid, TableClass.assignmentid, TableClass.hitid,
+                                   CodeMapping.anonymousid, TableClass.endhit) \
+                            .outerjoin(CodeMapping, CodeMapping.workerid == TableClass.workerid) \
+                            .filter(self.complete_filter(TableClass, class_exp))
+
+        if since is not None:
+            query = query.filter(sql.or_(TableClass.endhit >= since, TableClass.endhit.is_(None)))
+
+        return [(uniqueid, workerid, assignmentid, hitid, None if anonymousid is None else format_anonymous_id(anonymousid), endhit)
+                for uniqueid, workerid, assignmentid, hitid, anonymousid, endhit in query.all()]
+
+
+    def iter_subjects(self, experiment, uniqueids, chunk_size=500, yield_per=50):
+        '''
+        Streams full rows for the given subjects, with a server side cursor where the database
+        supports it, so that only a few datastrings are in memory at a time. Rows are detached
+        from the session before they're yielded, so changes to them are never written back and
+        they're freed once the caller is done with them.
+
+        :param uniqueids: subjects to load, queried chunk_size at a time to keep IN clauses small
+        :return: generator of (row, anonymousid) tuples, with anonymousid formatted as by
+                 get_anonymous_id, or None for workers not in the master list
+        '''
+        TableClass = get_class_by_tablename(experiment)
+        uniqueids = list(uniqueids)
+
+        for i in range(0, len(uniqueids), chunk_size):
+            rows = self.session.query(TableClass, CodeMapping.anonymousid) \
+                               .outerjoin(CodeMapping, CodeMapping.workerid == TableClass.workerid) \
+                               .filter(TableClass.uniqueid.in_(uniqueids[i:i + chunk_size])) \
+                               .execution_options(stream_results=True) \
+                               .yield_per(yield_per)
+
+            for row, anonymousid in rows:
+                self.session.expunge(row)
+                yield row, None if anonymousid is None else format_anonymous_id(anonymousid)
+
+
     def get_worker_id(self, anonymousid):
         workerid = self.session.query(CodeMapping.workerid).filter_by(anonymousid=anonymousid).first()
 
@@ -131,7 +191,7 @@ class DBManager(object):
         anonymousid = self.session.query(CodeMapping.anonymousid).filter_by(workerid=workerid).first()
 
         # row is None if not existing
-        return f"MTK{anonymousid[0]:05d}" if anonymousid else anonymousid
+        return format_anonymous_id(anonymousid[0]) if anonymousid else anonymousid
 
 
     def get_assignment_record(self, uniqueid):